@@ -1,47 +1,7 @@
-from setuptools import setup, find_packages
-import os
+# Project metadata and options are declared statically in setup.cfg,
+# which setuptools (>=30.3) reads on Python 2 as well as Python 3.
 
-version = '0.1dev'
-
-setup(
-    name='uu.record',
-    version=version,
-    description="Components for persistent data records within a CMF context.",
-    long_description=(
-        open("README.txt").read() + "\n" +
-        open(os.path.join("docs", "HISTORY.txt")).read()
-        ),
-    classifiers=[
-        "Programming Language :: Python",
-        "Intended Audience :: Developers",
-        "Framework :: Plone",
-        ],
-    keywords='',
-    author='Sean Upton',
-    author_email='sean.upton@hsc.utah.edu',
-    url='http://launchpad.net/upiq',
-    license='MIT',
-    packages=find_packages(exclude=['ez_setup']),
-    namespace_packages=['uu'],
-    include_package_data=True,
-    zip_safe=False,
-    install_requires=[
-        'setuptools',
-        'zope.schema>=3.8.0',
-        'zope.lifecycleevent',
-        'Products.CMFCore',
-        'repoze.catalog>=0.8.0',
-        'plone.uuid',
-        'zope.index',
-        # -*- Extra requirements: -*-
-    ],
-    extras_require={
-        'test': ['plone.testing>=4.0a6', 'zope.configuration'],
-    },
-    entry_points="""
-    # -*- Entry points: -*-
-    [z3c.autoinclude.plugin]
-    target = plone
-    """,
-    )
+if __name__ == '__main__':
+    from setuptools import setup
 
+    setup()
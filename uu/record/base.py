@@ -1,8 +1,10 @@
-import json
+import binascii
 import decimal
-import time
+import os
+import threading
 import uuid
 from datetime import date, datetime, timedelta
+from operator import itemgetter
 
 from Acquisition import aq_base
 from persistent import Persistent
@@ -12,12 +14,30 @@ from plone.uuid.interfaces import ATTRIBUTE_NAME as UUID_ATTR
 from zope.lifecycleevent import ObjectCreatedEvent, ObjectModifiedEvent
 from zope.lifecycleevent import ObjectAddedEvent, ObjectRemovedEvent
 from zope.lifecycleevent import Attributes
-from zope.interface import implements
+from zope.interface import implementer
+from BTrees.IOBTree import IOBTree
+from BTrees.OIBTree import OIBTree
 from BTrees.OOBTree import OOBTree
 
 from uu.record.interfaces import IRecord, IRecordContainer
 from utils import notify
 
+try:
+    from ujson import loads as _ujson_loads  # C parser, if available
+    from json import loads as _json_loads
+
+    def json_loads(data):
+        # parse floats exactly as the json module does (ujson 1.x
+        # defaults to a faster, but imprecise float conversion):
+        try:
+            return _ujson_loads(data, precise_float=True)
+        except (ValueError, OverflowError):
+            # ujson rejects some valid JSON, e.g. integers >= 2**64 or
+            # 1e400; the json module decides what is accepted.
+            return _json_loads(data)
+except ImportError:
+    from json import loads as json_loads
+
 
 def _normalize_uuid_representation(v):
     if isinstance(v, int) or isinstance(v, long):
@@ -34,18 +54,65 @@ def _normalize_uuid_representation(v):
     return v                            # fallback / unknown
 
 
-class Record(Persistent):
-    implements(IRecord)
+_uuid_pool = {'pid': None, 'bytes': '', 'offset': 0}
+_uuid_pool_lock = threading.Lock()
+UUID_POOL_SIZE = 256  # number of UUIDs worth of random bytes read at once
+
+
+def _uuid4_str():
+    """
+    Random (version 4) UUID in canonical string form, equivalent to
+    str(uuid.uuid4()), but slicing random bytes from a pool refilled with
+    one os.urandom() read per UUID_POOL_SIZE calls.  The pool is discarded
+    in forked child processes, so no two processes share random bytes.
+    """
+    pool = _uuid_pool
+    with _uuid_pool_lock:
+        offset = pool['offset']
+        if pool['pid'] != os.getpid() or offset >= len(pool['bytes']):
+            pool['pid'] = os.getpid()
+            pool['bytes'] = os.urandom(16 * UUID_POOL_SIZE)
+            offset = 0
+        pool['offset'] = offset + 16
+        raw = bytearray(pool['bytes'][offset:offset + 16])
+    raw[6] = (raw[6] & 0x0f) | 0x40  # version 4
+    raw[8] = (raw[8] & 0x3f) | 0x80  # RFC 4122 variant
+    h = binascii.hexlify(raw)
+    return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def _uid_str(v):
+    """
+    Interned string form of a UID: the same string object is then shared
+    by the record, the entries key and the order, and key comparisons of
+    identical UIDs short-circuit on identity.
+    """
+    return intern(str(v))
+
 
+# Positions in the container order are sparse integers keys of an IOBTree;
+# spacing them ORDER_GAP apart allows a record to be moved between two
+# neighbors by picking the midpoint key, without renumbering other records.
+ORDER_GAP = 2 ** 10
+ORDER_MIN, ORDER_MAX = -2 ** 31, 2 ** 31 - 1  # IOBTree keys are C int
+
+_MISSING = object()
+
+_get_record_uid = itemgetter('record_uid')
+
+
+@implementer(IRecord)
+class Record(Persistent):
     record_uid = None
 
     def __init__(self, context=None, uid=None):
-        self.record_uid = str(uid) if uid is not None else str(uuid.uuid4())
+        self.record_uid = _uid_str(uid if uid is not None else _uuid4_str())
         self._v_parent = None
 
     # compatibility w/ plone.uuid IAttributeUUID:
     def _set_uid(self, v):
-        self.record_uid = _normalize_uuid_representation(v)
+        v = _normalize_uuid_representation(v)
+        self.record_uid = _uid_str(v) if v is not None else None
 
     def _get_uid(self):
         return _normalize_uuid_representation(self.record_uid)
@@ -61,20 +128,26 @@ class Record(Persistent):
         return self.record_uid
 
 
+@implementer(IRecordContainer)
 class RecordContainer(Persistent):
     """
-    Base/default record container uses PersistentDict for entry storage
-    and PersistentList to store ordered keys.  This base container class
-    does not advocate one place of storage for the container in a ZODB
+    Base/default record container uses an OOBTree for entry storage and a pair
+    of BTrees (position to UID, UID to position) to store ordered keys, such
+    that membership checks, additions, removals, and re-ordering of keys do
+    not need to rewrite the order of the whole container.  This base container
+    class does not advocate one place of storage for the container in a ZODB
     over another, so subclass implementations may choose to implement a
     container within a placeful (e.g. OFS or CMF Content item) or placeless
-    (local utility) storage context.  Only a placeless context is supported
-    by direct users of this class (without subclassing).
+    (local utility) storage context.  Only a placeless context is supported by
+    direct users of this class (without subclassing).
 
-    For a container with hundreds of items or more, consider using instead
-    BTreeRecordContainer as an implementation or base class, as it should
-    handle memory usage and insert performance much better for larger sets
-    of records.
+    BTree buckets are loaded and stored independently, so memory usage and
+    insert performance scale with the records actually touched, not the
+    size of the container.  For small containers, a plain dict may be
+    passed as _impl to store entries within the container's own pickle
+    (saving a separate persistent object).  Containers stored by earlier
+    versions, with entries in a PersistentDict, are converted to BTrees on
+    their first write.
 
     Usage
     -----
@@ -112,6 +185,81 @@ class RecordContainer(Persistent):
     >>> assert container.values() == ()
     >>> assert container.items() == ()  # of course, these are empty now.
 
+    Entries are stored in an OOBTree by default; a small container may
+    instead store them in a plain dict kept in the container's own state:
+
+    >>> small = RecordContainer(_impl=dict)
+    >>> assert isinstance(small._entries, dict)
+
+    As the dict is not persistent itself, any change to it marks the
+    container as changed, including replacing a record already contained,
+    which does not change the container's size or order:
+
+    >>> import transaction
+    >>> from ZODB import DB
+    >>> from ZODB.MappingStorage import MappingStorage
+    >>> small_db = DB(MappingStorage())
+    >>> small_record = small.create({'count': 1})
+    >>> small.add(small_record)
+    >>> small_db.open().root()['small'] = small
+    >>> transaction.commit()
+    >>> assert not small._p_changed
+    >>> small[small_record.record_uid] = small.create({
+    ...     'record_uid': small_record.record_uid,
+    ...     'count': 2,
+    ...     })
+    >>> assert small._p_changed
+    >>> transaction.commit()
+    >>> small = small_db.open().root()['small']  # new connection: reloaded
+    >>> small.get(small_record.record_uid).count
+    2
+    >>> del(small[small_record.record_uid])
+    >>> assert small._p_changed
+    >>> transaction.commit()
+    >>> assert len(small_db.open().root()['small'].keys()) == 0
+    >>> transaction.abort()
+    >>> small_db.close()
+
+    Records need not be persistent objects; a container may use any factory
+    making records that provide IRecord:
+
+    >>> @implementer(IRecord)
+    ... class PlainRecord(object):
+    ...     def __init__(self, context=None, uid=None):
+    ...         self.record_uid = uid
+    ...
+    >>> plain = RecordContainer(factory=PlainRecord)
+    >>> plain.create({'count': 1}).count
+    1
+
+    A null record_uid in data for a new record is ignored, and a random
+    UUID is used, as when no record_uid is given:
+
+    >>> unnamed = container.create({'record_uid': None, 'count': 1})
+    >>> assert len(unnamed.record_uid) == 36
+
+    Keys of records set directly must be string UUIDs; besides str, also
+    str subclasses, unicode and uuid.UUID keys are stored as str:
+
+    >>> class UIDString(str):
+    ...     pass
+    ...
+    >>> keyed = RecordContainer()
+    >>> keyed_record = keyed.create()
+    >>> keyed[UIDString(keyed_record.record_uid)] = keyed_record
+    >>> assert type(keyed.keys()[0]) is str
+    >>> keyed['not-a-uuid'] = keyed_record
+    Traceback (most recent call last):
+    ...
+    KeyError: 'key does not appear to be string UUID: not-a-uuid'
+
+    Iterator variants avoid building a tuple, when a caller only needs to
+    loop over the contents:
+
+    >>> assert list(container.iterkeys()) == []
+    >>> assert list(container.itervalues()) == []
+    >>> assert list(container.iteritems()) == []
+
     Before we add records to a container, we need to create them; there are
     two possible ways to do this:
 
@@ -133,6 +281,8 @@ class RecordContainer(Persistent):
 
     >>> assert entry1.record_uid != entry2.record_uid
     >>> assert entry2.record_uid != randomuid
+    >>> assert uuid.UUID(entry1.record_uid).version == 4
+    >>> assert str(uuid.UUID(entry2.record_uid)) == entry2.record_uid
 
     The record objects provide plone.uuid.interfaces.IAttributeUUID as an
     alternative way to get the UUID value (string representation) by
@@ -166,6 +316,16 @@ class RecordContainer(Persistent):
     >>> assert entry6.count == 2
     >>> assert not hasattr(entry6, 'bad_value')  # function not copied!
 
+    Sequences and mappings are copied when their elements (keys and values)
+    are themselves of whitelisted types:
+
+    >>> entry7 = container.create(data={'tags'  : [u'monkey', u'banana'],
+    ...                                  'sizes' : {'small': 1},
+    ...                                  'misc'  : [lambda x: x]})
+    >>> assert entry7.tags == [u'monkey', u'banana']
+    >>> assert entry7.sizes == {'small': 1}
+    >>> assert not hasattr(entry7, 'misc')
+
     Of course, merely using the record container object as a factory for
     new records does not mean they are stored within (yet):
 
@@ -234,6 +394,8 @@ class RecordContainer(Persistent):
     >>> assert tuple(container.keys()) == expected_uid_order
     >>> assert tuple(container.values()) == expected_order
     >>> assert tuple(container.items()) == expected_items_order
+    >>> assert tuple(container.itervalues()) == expected_order
+    >>> assert tuple(container.iteritems()) == expected_items_order
 
     We can re-order this; let's move entry6 up to position 0 (first):
 
@@ -255,6 +417,63 @@ class RecordContainer(Persistent):
     >>> assert tuple(container.values()) == expected_order
     >>> assert tuple(container.items()) == expected_items_order
 
+    Containers stored by earlier versions keep their order in a
+    PersistentList; such a container is read as-is, and its order is
+    converted on the first write, to be stored along with that change:
+
+    >>> from persistent.list import PersistentList
+    >>> db = DB(MappingStorage())
+    >>> legacy = RecordContainer()
+    >>> for i in range(3):
+    ...     legacy.add(legacy.create())
+    ...
+    >>> legacy_uids = list(legacy.keys())
+    >>> legacy._order = PersistentList(legacy_uids)  # as stored before
+    >>> del(legacy._positions)
+    >>> db.open().root()['legacy'] = legacy
+    >>> transaction.commit()
+    >>> legacy = db.open().root()['legacy']  # new connection: loaded state
+    >>> assert list(legacy.keys()) == legacy_uids
+    >>> legacy.reorder(legacy_uids[2], 0)
+    >>> transaction.commit()
+    >>> legacy = db.open().root()['legacy']
+    >>> assert list(legacy.keys()) == [legacy_uids[i] for i in (2, 0, 1)]
+    >>> assert len(legacy) == 3
+    >>> assert not isinstance(legacy._order, PersistentList)
+    >>> assert isinstance(legacy._entries, OOBTree)
+
+    Replacing an existing entry of a legacy container, which does not
+    change its order, is stored the same way:
+
+    >>> from persistent.dict import PersistentDict
+    >>> legacy = RecordContainer()
+    >>> for i in range(3):
+    ...     legacy.add(legacy.create({'count': i}))
+    ...
+    >>> legacy_uids = list(legacy.keys())
+    >>> legacy._entries = PersistentDict(legacy._entries)
+    >>> legacy._order = PersistentList(legacy_uids)
+    >>> del(legacy._positions)
+    >>> db.open().root()['legacy'] = legacy
+    >>> transaction.commit()
+    >>> legacy = db.open().root()['legacy']
+    >>> legacy[legacy_uids[0]] = legacy.create({
+    ...     'record_uid': legacy_uids[0],
+    ...     'count': 99,
+    ...     })
+    >>> transaction.commit()
+    >>> legacy = db.open().root()['legacy']
+    >>> [legacy[uid].count for uid in legacy_uids]
+    [99, 1, 2]
+
+    A PersistentDict explicitly given as _impl is kept as it is:
+
+    >>> keep = RecordContainer(_impl=PersistentDict)
+    >>> keep.add(keep.create())
+    >>> assert type(keep._entries) is PersistentDict
+    >>> transaction.abort()
+    >>> db.close()
+
     And we can remove records from containment by UID or by reference (note,
     del(container[key]) uses __delitem__ since a container is a writable
     mapping):
@@ -337,7 +556,8 @@ class RecordContainer(Persistent):
     ----------------
 
     As a convenience, update_all() parses JSON into a data dict for use by
-    update(), using the Python 2.6 json library (aka/was: simplejson):
+    update(), using ujson if installed, otherwise the Python 2.6 json library
+    (aka/was: simplejson):
 
     >>> party_form = RecordContainer()
     >>> entry = party_form.create()
@@ -405,6 +625,45 @@ class RecordContainer(Persistent):
     It should be noted that update_all() removes entries not in the data
     payload, and it preserves the order contained in the JSON entries.
 
+    A subclass may override update(), with its documented signature, and
+    update_all() calls it for each entry:
+
+    >>> class LoggingForm(RecordContainer):
+    ...     def update(self, data, suppress_notify=False):
+    ...         print 'update', data['name']
+    ...         return super(LoggingForm, self).update(data, suppress_notify)
+    ...
+    >>> logging_form = LoggingForm()
+    >>> logging_form.update_all(json.dumps([data]))
+    update Party monkey
+    >>> assert logging_form.get(data['record_uid']).name == u'Party monkey'
+
+    Every entry must name the UID of its record; an entry with a null UID
+    is rejected before any entry is updated:
+
+    >>> party_form.update_all(json.dumps([
+    ...     data,
+    ...     {'record_uid': None, 'name': 'New row'},
+    ...     ]))
+    Traceback (most recent call last):
+    ...
+    ValueError: empty record UID on update
+    >>> assert 'None' not in party_form
+    >>> assert list(party_form.keys()) == [data['record_uid']]
+
+    Whichever parser is used, any valid JSON is accepted, including
+    integers too large for ujson:
+
+    >>> party_form.update_all(
+    ...     '[{"record_uid": "%s", "count": 18446744073709551616}]' % (
+    ...         data['record_uid'],))
+    >>> party_form.get(data['record_uid']).count
+    18446744073709551616L
+
+    Object events for records created, modified, added or removed by
+    update_all() are dispatched, in order, once all entries have been
+    updated, followed by a single modified event for the container.
+
     Object events
     -------------
 
@@ -536,78 +795,211 @@ class RecordContainer(Persistent):
     ...                            'title'      : u'Hello'})
     ('title',)
 
+    All fields changed by one update are named by a single description,
+    and fields whose values are unchanged are not included:
+
+    >>> entry = container.update({'record_uid' : entry.record_uid,
+    ...                            'title'      : u'Hello',
+    ...                            'count'      : 99})
+    ('count',)
+    >>> entry = container.update({'record_uid' : entry.record_uid,
+    ...                            'title'      : u'Goodbye',
+    ...                            'count'      : 100})
+    ('count', 'title')
+
+    Record events of update_all() are dispatched in order only after all
+    entries are updated, removed and re-ordered, so that handlers see the
+    container in its final state; one modified event for the container
+    follows them:
+
+    >>> @adapter(IRecordContainer, IObjectModifiedEvent)
+    ... def handle_container_modify(context, event):
+    ...     print 'container modified'
+    ...
+    >>> gsm.registerHandler(handle_container_modify)
+    >>> unregistered = gsm.unregisterHandler(handle_add)
+    >>> @adapter(IRecord, IObjectAddedEvent)
+    ... def handle_add(context, event):
+    ...     print 'object added, container size: %s' % len(event.newParent)
+    ...
+    >>> gsm.registerHandler(handle_add)
+    >>> batch = RecordContainer()
+    >>> batch.add(batch.create())
+    object created
+    object added, container size: 1
+    >>> batch.update_all([{'record_uid': str(uuid.uuid4()),
+    ...                    'title': u'Replacement'}])
+    ('title',)
+    object created
+    object added, container size: 1
+    object removed
+    container modified
+
     Finally, clean up and remove all the dummy handlers:
-    >>> for h in (handle_create, handle_modify, handle_remove, handle_add):
+    >>> for h in (handle_create, handle_modify, handle_remove, handle_add,
+    ...           handle_container_modify):
     ...     success = gsm.unregisterHandler(h)
     ...
 
     """
 
-    implements(IRecordContainer)
-
     # whitelist types of objects to copy on data update:
 
-    TYPE_WHITELIST = (int,
-                      long,
-                      str,
-                      unicode,
-                      bool,
-                      float,
-                      time.time,
-                      datetime,
-                      date,
-                      timedelta,
-                      decimal.Decimal,)
+    TYPE_WHITELIST = frozenset((int,
+                                long,
+                                str,
+                                unicode,
+                                bool,
+                                float,
+                                datetime,
+                                date,
+                                timedelta,
+                                decimal.Decimal,))
 
-    SEQUENCE_WHITELIST = (list, tuple, set, frozenset, PersistentList,)
+    SEQUENCE_WHITELIST = frozenset((list, tuple, set, frozenset,
+                                    PersistentList,))
 
-    MAPPING_WHITELIST = (dict, PersistentDict,)
+    MAPPING_WHITELIST = frozenset((dict, PersistentDict,))
 
     RECORD_INTERFACE = IRecord
 
     factory = Record
 
-    def __init__(self, factory=Record, _impl=PersistentDict):
+    def __init__(self, factory=Record, _impl=OOBTree):
         self._entries = _impl()
-        self._order = PersistentList()
+        self._set_order(())
+        self._size = 0
         self.factory = factory
 
+    def _migrate(self):
+        """
+        Convert storage of a container stored by an earlier version (order
+        in a PersistentList, entries in the then-default PersistentDict) to
+        BTrees; called by write methods before they modify the container,
+        and marks the container as changed, so that the new BTrees are
+        stored along with it.  Entries of containers created with an
+        explicit _impl are left as they are.
+        """
+        if isinstance(self._order, PersistentList):
+            if type(self._entries) is PersistentDict:
+                self._entries = OOBTree(self._entries)
+            self._size = len(self._order)
+            self._set_order(self._order)
+            self._p_changed = True
+
+    # ordering storage (sparse position keys, see ORDER_GAP):
+
+    def _set_order(self, uids):
+        order, positions = IOBTree(), OIBTree()
+        for idx, uid in enumerate(uids):
+            order[idx * ORDER_GAP] = uid
+            positions[uid] = idx * ORDER_GAP
+        self._order, self._positions = order, positions
+
+    def _order_values(self):
+        order = self._order
+        if isinstance(order, PersistentList):
+            return order  # not yet migrated, read as-is (see _migrate())
+        return order.values()
+
+    def _order_append(self, uid):
+        pos = (self._order.maxKey() + ORDER_GAP) if self._order else 0
+        if pos > ORDER_MAX:
+            self._set_order(self._order.values())  # renumber, reclaim space
+            pos = self._order.maxKey() + ORDER_GAP
+        self._order[pos] = uid
+        self._positions[uid] = pos
+
+    def _order_remove(self, uid):
+        del(self._order[self._positions.pop(uid)])
+
+    def _order_insert(self, uid, offset):
+        keys = self._order.keys()
+        try:
+            after = keys[offset]  # walks only buckets up to offset
+        except IndexError:
+            return self._order_append(uid)
+        before = keys[offset - 1] if offset else after - 2 * ORDER_GAP
+        pos = (before + after) // 2
+        if pos == before or pos < ORDER_MIN:
+            # no room between neighbors: renumber, then try again
+            self._set_order(self._order.values())
+            return self._order_insert(uid, offset)
+        self._order[pos] = uid
+        self._positions[uid] = pos
+
+    def _notify(self, event):
+        """
+        Notify record event, or, during update_all(), queue it to be
+        dispatched (in order) once all entries have been updated.
+        """
+        pending = getattr(self, '_v_pending_events', None)
+        if pending is not None:
+            pending.append(event)
+        else:
+            notify(event)
+
+    def _is_record(self, obj):
+        # exact type check for records made by self.factory is much cheaper
+        # than interface lookup, which remains the fallback for other objects
+        return (type(obj) is self.factory or
+                self.RECORD_INTERFACE.providedBy(obj))
+
     # IWriteContainer methods:
 
-    def _update_size(self):
-        self._size = len(self._order)
+    def _update_size(self, delta):
+        # counted, as len() of the position BTree would load all buckets
+        self._size = len(self) + delta
         self._p_changed = True
 
+    def _entries_changed(self):
+        if not isinstance(self._entries, Persistent):
+            self._p_changed = True  # plain dict is stored in our own state
+
+    def _set_entry(self, uid, record):
+        self._migrate()
+        if self._entries.get(uid) is not record:  # avoid no-op bucket write
+            self._entries[uid] = record
+            self._entries_changed()
+        if uid not in self._positions:
+            self._order_append(uid)
+            self._update_size(1)
+
     def __setitem__(self, key, value):
-        if isinstance(key, uuid.UUID) or isinstance(key, unicode):
-            key = str(key)
-        elif not (isinstance(key, str) and len(key) == 36):
-            raise KeyError('key does not appear to be string UUID: %s', key)
-        if not self.RECORD_INTERFACE.providedBy(value):
+        if not (type(key) is str and len(key) == 36):  # common case first
+            if (isinstance(key, uuid.UUID) or isinstance(key, unicode) or
+                    (isinstance(key, str) and len(key) == 36)):
+                key = str(key)  # str subclass to str, as intern() requires
+            else:
+                raise KeyError(
+                    'key does not appear to be string UUID: %s' % (key,))
+        if not self._is_record(value):
             raise ValueError('Record value must provide %s' % (
                 self.RECORD_INTERFACE.__identifier__))
-        self._entries[key] = value
-        if key not in self._order:
-            self._order.append(key)
-            self._update_size()
+        self._set_entry(intern(key), value)
 
     def __delitem__(self, record):
         uid = record
-        if self.RECORD_INTERFACE.providedBy(record):
-            uid = str(record.record_uid)
-        elif isinstance(record, uuid.UUID):
-            uid = str(record)
+        is_record = False
+        if type(record) is not str:
+            is_record = self._is_record(record)
+            if is_record:
+                uid = str(record.record_uid)
+            elif isinstance(record, uuid.UUID):
+                uid = str(record)
         if not (isinstance(uid, str) and len(uid) == 36):
             raise ValueError('record neither record object nor UUID')
+        self._migrate()
         if uid not in self._entries:
             raise ValueError('record not found contained within')
-        if uid in self._order:
-            self._order.remove(uid)
-            self._update_size()
-        if not self.RECORD_INTERFACE.providedBy(record):
+        if uid in self._positions:
+            self._order_remove(uid)
+            self._update_size(-1)
+        if not is_record:
             record = self._entries.get(uid)  # need ref for event notify below
         del(self._entries[uid])
-        notify(ObjectRemovedEvent(record, self, uid))
+        self._entries_changed()
+        self._notify(ObjectRemovedEvent(record, self, uid))
 
     # IRecordContainer and IOrdered re-ordering methods:
 
@@ -619,24 +1011,25 @@ class RecordContainer(Persistent):
         """
         uid = record
         offset = abs(int(offset))
-        if self.RECORD_INTERFACE.providedBy(record):
+        if self._is_record(record):
             uid = record.record_uid
-        if not uid or uid not in self._order:
+        self._migrate()
+        if not uid or uid not in self._positions:
             raise ValueError('cannot find record to move for id %s' % uid)
-        self._order.insert(offset, self._order.pop(self._order.index(uid)))
+        self._order_remove(uid)
+        self._order_insert(uid, offset)
 
     def updateOrder(self, order):
         """Provides zope.container.interfaces.IOrdered.updateOrder"""
-        if len(order) != len(self._order):
+        self._migrate()
+        if len(order) != len(self):
             raise ValueError('invalid number of keys')
         s_order = set(order)
         if len(order) != len(s_order):
             raise ValueError('duplicate keys in order')
-        if s_order - set(self._order):
+        if s_order - set(self._positions.keys()):
             raise ValueError('unknown key(s) provided in order')
-        if not isinstance(order, PersistentList):
-            order = PersistentList(order)
-        self._order = order
+        self._set_order(order)
 
     # IReadContainer interface methods:
 
@@ -644,9 +1037,11 @@ class RecordContainer(Persistent):
         """
         Get object providing IRecord for given UUID uid or return None
         """
-        if self.RECORD_INTERFACE.providedBy(uid):
-            uid = uid.record_uid   # special case to support __contains__() impl
-        v = self._entries.get(str(uid), default)
+        if type(uid) is not str:
+            if self._is_record(uid):
+                uid = uid.record_uid  # special case to support __contains__()
+            uid = str(uid)
+        v = self._entries.get(uid, default)
         if v and getattr(v, '_v_parent', None) is None:
             v._v_parent = self  # container marks item with itself as context
         return v
@@ -655,7 +1050,9 @@ class RecordContainer(Persistent):
         """
         Given record as either IRecord object or UUID, is record contained?
         """
-        if self.RECORD_INTERFACE.providedBy(record):
+        if type(record) is str:
+            return record in self._entries
+        if self._is_record(record):
             return self.get(record, None) is not None
         return str(record) in self._entries
 
@@ -675,33 +1072,49 @@ class RecordContainer(Persistent):
 
     def keys(self):
         """return tuple with elements ordered"""
-        return tuple(self._order)
+        return tuple(self._order_values())
 
     def values(self):
         """return tuple of records in order"""
-        return tuple([t[1] for t in self.items()])
+        return tuple(self.itervalues())
 
     def items(self):
         """return ordered pairs of key/values"""
-        return tuple([(uid, self.get(uid)) for uid in self._order])
+        return tuple(self.iteritems())
+
+    def iterkeys(self):
+        """return iterator over keys in order, without building a tuple"""
+        return iter(self._order_values())
+
+    def itervalues(self):
+        """return iterator over records in order"""
+        get = self.get
+        for uid in self._order_values():
+            yield get(uid)
+
+    def iteritems(self):
+        """return iterator over ordered pairs of key/values"""
+        get = self.get
+        for uid in self._order_values():
+            yield (uid, get(uid))
 
-    def __iter__(self):
-        return self._order.__iter__()
+    __iter__ = iterkeys
 
     # IRecordContainer-specific CRUD methods:
 
     def _type_whitelist_validation(self, value):
         vtype = type(value)
+        whitelist = self.TYPE_WHITELIST
         if vtype in self.MAPPING_WHITELIST:
             for k, v in value.items():
-                if not (k in self.TYPE_WHITELIST and v in self.TYPE_WHITELIST):
+                if not (type(k) in whitelist and type(v) in whitelist):
                     raise ValueError('Unsupported mapping key/value type')
         elif vtype in self.SEQUENCE_WHITELIST:
             for v in value:
-                if v not in self.TYPE_WHITELIST:
+                if type(v) not in whitelist:
                     raise ValueError('Unsupported sequence value type')
         else:
-            if vtype not in self.TYPE_WHITELIST:
+            if vtype not in whitelist:
                 raise ValueError('Unsupported data type')
 
     def _populate_record(self, record, data):
@@ -712,27 +1125,33 @@ class RecordContainer(Persistent):
         copy of names, and normalization of values if/as necessary.
         """
         changelog = []
+        if isinstance(record, Persistent):
+            record._p_activate()  # ensure record.__dict__ is loaded, not ghost
+        state_get = record.__dict__.get
+        validate = self._type_whitelist_validation  # bound once, not per key
         for key, value in data.items():
             if key.startswith('_'):
                 continue  # invalid key
             if key == 'record_uid':
-                self.record_uid = str(value)
+                if value is not None:
+                    record.record_uid = _uid_str(value)
                 continue
             try:
-                self._type_whitelist_validation(value)
+                validate(value)
             except ValueError:
                 continue  # skip problem name!
-            existing_value = getattr(self, key, None)
-            if value != existing_value:
-                changelog.append(key)
-                setattr(record, key, value)
+            existing_value = state_get(key, _MISSING)
+            if value is existing_value or value == existing_value:
+                continue  # unchanged
+            changelog.append(key)
+            setattr(record, key, value)
         if changelog:
             record._p_changed = True
-            changelog = [
-                Attributes(self.RECORD_INTERFACE, name)
-                for name in changelog
-                ]
-            notify(ObjectModifiedEvent(record, *changelog))
+            # one description naming all changed fields, not one per field:
+            self._notify(ObjectModifiedEvent(
+                record,
+                Attributes(self.RECORD_INTERFACE, *sorted(changelog)),
+                ))
 
     def create(self, data=None):
         """
@@ -741,13 +1160,15 @@ class RecordContainer(Persistent):
         """
         if data is None:
             data = {}
-        uid = data.get('record_uid', str(uuid.uuid4()))  # get or random uuid
+        uid = data.get('record_uid', None)
+        if uid is None:
+            uid = _uuid4_str()  # random uuid only when none is given
         record = self.factory(context=self, uid=uid)
         if data and (hasattr(data, 'get') and
                      hasattr(data, 'items')):
             self._before_populate(record, data)
             self._populate_record(record, data)
-        notify(ObjectCreatedEvent(record))
+        self._notify(ObjectCreatedEvent(record))
         return record
 
     def add(self, record):
@@ -756,22 +1177,22 @@ class RecordContainer(Persistent):
         write existing entry if already exists for a UUID (in such case
         leave order as-is).
         """
-        uid = str(record.record_uid)
+        uid = _uid_str(record.record_uid)
         if not uid:
             raise ValueError('record has empty UUID')
-        self._entries[uid] = record
-        if uid not in self._order:
-            self._order.append(uid)
-            self._update_size()
-        notify(ObjectAddedEvent(record, self, uid))
+        self._set_entry(uid, record)
+        self._notify(ObjectAddedEvent(record, self, uid))
 
     def _ad_hoc_fieldlist(self, record):
-        attrs = [name for name in dir(record) if not name.startswith('_')]
+        if isinstance(record, Persistent):
+            record._p_activate()  # ensure record.__dict__ is loaded, not ghost
         fieldnames = []
-        for name in attrs:
-            v = getattr(record, name)
+        validate = self._type_whitelist_validation
+        for name, v in record.__dict__.items():
+            if name.startswith('_'):
+                continue
             try:
-                self._type_whitelist_validation(v)
+                validate(v)
                 fieldnames.append(name)
             except ValueError:
                 pass  # ignore name
@@ -823,14 +1244,21 @@ class RecordContainer(Persistent):
             is the context of record).
 
         """
-        if self.RECORD_INTERFACE.providedBy(data):
+        if self._is_record(data):
             uid = data.record_uid
             data = self._filtered_data(data)
         else:
             uid = data.get('record_uid', None)
         if uid is None:
             raise ValueError('empty record UID on update')
-        uid = str(uid)
+        return self._update_entry(data, str(uid), suppress_notify)
+
+    def _update_entry(self, data, uid, suppress_notify=False):
+        """
+        Update or add entry for (already normalized) string uid from data;
+        implementation of update(), also used by update_all() unless a
+        subclass overrides update().
+        """
         record = self.get(uid, None)
         if record is not None:
             # existing record, already known/saved
@@ -848,6 +1276,28 @@ class RecordContainer(Persistent):
     def _process_container_metadata(self, data):
         return False  # hook for subclasses
 
+    def _parse_json_update(self, data):
+        """
+        Given JSON serialization of one entry, a list of entries, or a
+        wrapper object containing a list of 'entries', return list of
+        entry data dicts with str keys.
+        """
+        _data = json_loads(data)
+        if isinstance(_data, dict):
+            # dict might be singluar item, or wrapping object; a wrapping
+            # object would have a list called 'entries'
+            if 'entries' in _data and isinstance(_data['entries'], list):
+                if len(_data) > 1:
+                    # wrapper has metadata beyond its entries to process
+                    self._process_container_metadata(_data)
+                # wrapper, get entries from within.
+                _data = _data['entries']
+            else:
+                # singular record, not a wrapper
+                _data = [_data]  # wrap singular item update in list
+        _keynorm = lambda o: dict([(str(k), v) for k, v in o.items()])
+        return [_keynorm(o) for o in _data]
+
     def update_all(self, data):
         """
         Given sequence of data dictionaries or a JSON serialization
@@ -855,45 +1305,48 @@ class RecordContainer(Persistent):
         any item/entry.  Also supports JSON serialization of a single
         record/entry dict.
         """
-        _modified = False
         if isinstance(data, basestring):
-            _data = json.loads(data)
-            if isinstance(_data, dict):
-                # dict might be singluar item, or wrapping object; a wrapping
-                # object would have a list called 'entries'
-                if 'entries' in _data and isinstance(_data['entries'], list):
-                    _modified = self._process_container_metadata(_data)
-                    # wrapper, get entries from within.
-                    _data = _data['entries']
+            data = self._parse_json_update(data)
+        if not all('record_uid' in entry_data for entry_data in data):
+            raise ValueError('record missing UID')
+        if any(entry_data['record_uid'] is None for entry_data in data):
+            raise ValueError('empty record UID on update')
+        self._migrate()
+        uids = map(_uid_str, map(_get_record_uid, data))
+        keep_uids = set(uids)
+        # UIDs are normalized above, so skip update() unless overridden:
+        direct = type(self).update.im_func is RecordContainer.update.im_func
+        pending = self._v_pending_events = []
+        try:
+            for entry_data, uid in zip(data, uids):
+                if direct:
+                    self._update_entry(entry_data, uid, suppress_notify=True)
                 else:
-                    # singular record, not a wrapper
-                    _data = [_data]  # wrap singular item update in list
-            _keynorm = lambda o: dict([(str(k), v) for k, v in o.items()])
-            data = [_keynorm(o) for o in _data]
-        uids = [str(o['record_uid']) for o in data]
-        existing_uids = set(self.keys())
-        added_uids = set(uids) - existing_uids
-        modified_uids = set(uids).intersection(existing_uids)
-        for entry_data in data:
-            if 'record_uid' not in entry_data:
-                raise ValueError('record missing UID')
-            record = self.update(entry_data, suppress_notify=True)
-            if not _modified and getattr(record, '_p_changed', None):
-                _modified = True
-        remove_uids = existing_uids - set(uids)
-        for deluid in remove_uids:
-            del(self[deluid])  # remove any previous entries not in the form
-        self._order = PersistentList(uids)  # replace old with new uid order
-        if added_uids or modified_uids:
-            _modified = True
-        if data and _modified:
-            self.notify_data_changed()  # notify just once
+                    self.update(entry_data, suppress_notify=True)
+            # single ordered pass over existing keys, no set of all keys:
+            remove_uids = [
+                uid for uid in self._order.values() if uid not in keep_uids
+                ]
+            for deluid in remove_uids:
+                del(self[deluid])  # remove previous entries not in the form
+            if tuple(self._order.values()) != tuple(uids):
+                self._set_order(uids)  # replace old with new uid order
+        finally:
+            self._v_pending_events = None
+        for event in pending:
+            notify(event)  # record events, batched after all changes
+        if data:
+            # each entry given was either added or modified; notify just once
+            self.notify_data_changed()
 
 
 class BTreeRecordContainer(RecordContainer):
-    """Record container uses OOBTree for entry storage"""
+    """
+    Record container uses OOBTree for entry storage; this is now also the
+    default for RecordContainer, this class is kept for compatibility.
+    """
 
-    def __init__(self, _impl=OOBTree):
-        super(BTreeRecordContainer, self).__init__(_impl)
+    def __init__(self, factory=Record, _impl=OOBTree):
+        super(BTreeRecordContainer, self).__init__(factory, _impl=_impl)
 
 
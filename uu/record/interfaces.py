@@ -126,6 +126,15 @@ class IRecordContainer(IOrderedContainer):
     def items():
         """return ordered pairs of key/values"""
 
+    def iterkeys():
+        """Return iterator over keys (uuids) in order"""
+
+    def itervalues():
+        """Return iterator over records in order"""
+
+    def iteritems():
+        """Return iterator over ordered pairs of key/values"""
+
     def __iter__():
         """Return iterator for the keys (uuids) / self.order"""
 
@@ -154,7 +163,7 @@ class IRecordResolver(Interface):
 
     >>> import uuid
     >>> from zope.component import queryUtility, getGlobalSiteManager
-    >>> from zope.interface import implements
+    >>> from zope.interface import implementer
     >>> from uu.record.interfaces import IRecordResolver
 
     Dummy record object with some arbitrary implementation-specific
@@ -171,8 +180,8 @@ class IRecordResolver(Interface):
 
     Create and register a trivial example resolver:
 
-    >>> class DummyResolver(object):
-    ...     implements(IRecordResolver)
+    >>> @implementer(IRecordResolver)
+    ... class DummyResolver(object):
     ...     def __call__(self, uid):
     ...         uid = str(uid)
     ...         if uid == dummy.uid:
@@ -1,11 +1,67 @@
+import threading
+import time
+from collections import OrderedDict
 
-from zope.interface import implements
+from AccessControl import getSecurityManager
+from zope.interface import implementer
 from zope.component.hooks import getSite
 from Products.CMFCore.utils import getToolByName
 
 from uu.record.interfaces import IRecordResolver
 
 
+# per-thread memo of the last site seen and its catalog tool, shared by all
+# resolver instances; only reused while getSite() returns that same object,
+# so a catalog from another request's connection is never handed out.
+_site_cache = threading.local()
+
+
+def _site_catalog():
+    portal = getSite()
+    if getattr(_site_cache, 'portal', None) is not portal:
+        _site_cache.catalog = getToolByName(portal, 'portal_catalog')
+        _site_cache.portal = portal
+    return portal, _site_cache.catalog
+
+
+def clear_caches(event=None):
+    """
+    Forget context paths and missing UIDs remembered by resolvers in this
+    thread; subscribed to the end of each request by resolver.zcml, as
+    what the catalog finds depends on the site and user of a request.
+    """
+    _site_cache.paths = {}  # uid -> (expiry time, context path)
+    _site_cache.misses = OrderedDict()  # uid -> expiry time, oldest first
+    _site_cache.scope = (None, None)  # (site, user id) these are for
+
+
+def record_added(record, event):
+    """
+    Subscriber for records added: forget any remembered miss of the UID
+    of the record, so that it resolves without waiting for MISS_TTL.
+    """
+    misses = getattr(_site_cache, 'misses', None)
+    if misses:
+        misses.pop(str(record.record_uid), None)
+
+
+def _caches():
+    """
+    Per-thread state of resolvers for the current site and user: portal,
+    catalog, remembered paths and misses; looked up once per resolver
+    call, as remembered paths and misses are only valid for one site and
+    user.
+    """
+    portal = _site_catalog()[0]
+    user_id = getSecurityManager().getUser().getId()
+    site, user = getattr(_site_cache, 'scope', (None, None))
+    if site is not portal or user != user_id:
+        clear_caches()
+        _site_cache.scope = (portal, user_id)
+    return _site_cache
+
+
+@implementer(IRecordResolver)
 class CatalogRecordResolver(object):
     """
     Resolve record object by finding its parent using Plone catalog search
@@ -15,38 +71,318 @@ class CatalogRecordResolver(object):
     provides IItemMapping or zope.container.interfaces.IReadContainer; this
     assumption isn't checked, we just duck-type assuming any context that
     looks like a mapping, and has a get() method taking a key.
-    """
     
-    implements(IRecordResolver)
+    Paths of contexts found are remembered for CACHE_TTL seconds, such
+    that repeated resolution of the same UID traverses to its context
+    without a catalog query; a remembered context is only used if it
+    (still) contains the record.  UIDs not found at all are remembered
+    for a shorter MISS_TTL, so repeated lookups of stale UIDs do not each
+    query the catalog.
+    
+    The portal and catalog are looked up for the current site on each
+    use, and caches are kept per thread, for the current site and user
+    only, so a single instance may be shared by all requests; such an
+    instance is registered as the IRecordResolver utility by resolver.zcml,
+    which sites using this resolver include explicitly, along with
+    subscribers clearing the caches at the end of each request and
+    forgetting misses of records added.
+    
+    Usage
+    -----
+    
+    For demonstration, a stand-in site traverses paths to containers of
+    records, and its catalog finds the containers of given UIDs, only for
+    users allowed to view them:
+    
+    >>> from AccessControl import getSecurityManager
+    >>> from AccessControl.SecurityManagement import newSecurityManager
+    >>> from AccessControl.SecurityManagement import noSecurityManager
+    >>> from zope.component import getGlobalSiteManager
+    >>> from zope.component.hooks import setSite
+    >>> from uu.record.base import Record
+    >>> class Brain(object):
+    ...     def __init__(self, site, path):
+    ...         self.site, self.path = site, path
+    ...     def getPath(self):
+    ...         return self.path
+    ...     def getObject(self):
+    ...         return self.site.restrictedTraverse(self.path)
+    ...
+    >>> class Catalog(object):
+    ...     def __init__(self, site):
+    ...         self.site, self.queries = site, []
+    ...     def query(self, query):
+    ...         self.queries.append(query)
+    ...         uids = query['contained_uids']
+    ...         if isinstance(uids, dict):
+    ...             uids = uids['query']  # 'or' of several UIDs
+    ...         else:
+    ...             uids = [uids]
+    ...         user_id = getSecurityManager().getUser().getId()
+    ...         if user_id not in self.site.viewers:
+    ...             return []
+    ...         return [Brain(self.site, path)
+    ...                 for path, container in sorted(self.site.paths.items())
+    ...                 if [uid for uid in uids if uid in container]]
+    ...
+    >>> class Site(object):
+    ...     def __init__(self):
+    ...         self.paths = {'/site/a': {}, '/site/b': {}}
+    ...         self.viewers = set(['admin'])
+    ...         self.portal_catalog = Catalog(self)
+    ...     def getSiteManager(self):
+    ...         return getGlobalSiteManager()
+    ...     def restrictedTraverse(self, path, default=None):
+    ...         return self.paths.get(path, default)
+    ...
+    >>> class User(object):
+    ...     def __init__(self, user_id):
+    ...         self.user_id = user_id
+    ...     def getId(self):
+    ...         return self.user_id
+    ...
+    >>> site = Site()
+    >>> setSite(site)
+    >>> newSecurityManager(None, User('admin'))
+    >>> queries = site.portal_catalog.queries
+    >>> record = Record()
+    >>> site.paths['/site/a'][record.record_uid] = record
+    
+    A record is resolved with one catalog query; its context path is then
+    remembered, so it resolves again without another query:
+    
+    >>> resolver = CatalogRecordResolver()
+    >>> assert resolver(record.record_uid) is record
+    >>> len(queries)
+    1
+    >>> assert resolver.contained(record.record_uid) == (
+    ...     site.paths['/site/a'], record)
+    >>> len(queries)
+    1
+    
+    A record moved elsewhere is no longer in its remembered context, so it
+    is looked up by a query again:
+    
+    >>> site.paths['/site/b'][record.record_uid] = (
+    ...     site.paths['/site/a'].pop(record.record_uid))
+    >>> assert resolver.contained(record.record_uid) == (
+    ...     site.paths['/site/b'], record)
+    >>> len(queries)
+    2
+    
+    A UID not found is remembered as missing for MISS_TTL seconds, unless
+    a record with that UID is added (record_added() is subscribed to
+    added events of records by resolver.zcml):
+    
+    >>> added = Record()
+    >>> assert resolver(added.record_uid) is None
+    >>> assert resolver(added.record_uid) is None
+    >>> len(queries)
+    3
+    >>> site.paths['/site/a'][added.record_uid] = added
+    >>> record_added(added, None)
+    >>> assert resolver(added.record_uid) is added
+    >>> len(queries)
+    4
+    
+    Catalog results depend on the user, so remembered paths and misses
+    are forgotten when the user (or site) changes; a user not allowed to
+    view the record does not find it, and its miss does not hide the
+    record from other users:
+    
+    >>> newSecurityManager(None, User('anonymous'))
+    >>> assert resolver(record.record_uid) is None
+    >>> newSecurityManager(None, User('admin'))
+    >>> assert resolver(record.record_uid) is record
+    >>> len(queries)
+    6
+    >>> other_site = Site()
+    >>> other_site.paths['/site/b'][record.record_uid] = record
+    >>> setSite(other_site)
+    >>> assert resolver(record.record_uid) is record
+    >>> (len(queries), len(other_site.portal_catalog.queries))
+    (6, 1)
+    >>> setSite(site)
+    >>> assert resolver(record.record_uid) is record
+    >>> len(queries)
+    7
+    
+    resolve_many() resolves records with remembered paths without any
+    query, and all other UIDs with a single 'or' query:
+    
+    >>> others = [Record(), Record()]
+    >>> for other in others:
+    ...     site.paths['/site/a'][other.record_uid] = other
+    ...
+    >>> missing_uid = Record().record_uid
+    >>> uids = [record.record_uid, missing_uid] + [
+    ...     other.record_uid for other in others]
+    >>> result = resolver.resolve_many(uids)
+    >>> assert result == {
+    ...     record.record_uid: record,
+    ...     missing_uid: None,
+    ...     others[0].record_uid: others[0],
+    ...     others[1].record_uid: others[1],
+    ...     }
+    >>> len(queries)
+    8
+    >>> sorted(queries[-1]['contained_uids']['query']) == sorted(
+    ...     [missing_uid] + [other.record_uid for other in others])
+    True
+    
+    Caches are cleared at the end of each request (clear_caches() is
+    subscribed to IEndRequestEvent by resolver.zcml):
+    
+    >>> clear_caches()
+    >>> assert resolver(record.record_uid) is record
+    >>> len(queries)
+    9
+    
+    Clean up:
+    
+    >>> clear_caches()
+    >>> noSecurityManager()
+    >>> setSite(None)
+    """
     
     INDEX_NAME = 'contained_uids'  # needs to be KeywordIndex in portal_catalog
-    loaded = False
+    CACHE_TTL = 60      # seconds a context path found for a UID is trusted
+    CACHE_SIZE = 1024   # maximum number of UIDs with remembered paths
+    MISS_TTL = 5        # seconds a UID not found is assumed still missing
+    
+    @property
+    def portal(self):
+        return _site_catalog()[0]
+    
+    @property
+    def catalog(self):
+        return _site_catalog()[1]
+    
+    # helpers below take the caches looked up once per call, see _caches()
+    
+    def _cached_context(self, caches, uid):
+        cached = caches.paths.get(uid)
+        if cached is None:
+            return None
+        expires, path = cached
+        if expires > time.time():
+            context = caches.portal.restrictedTraverse(path, None)
+            if context is not None and context.get(uid, None) is not None:
+                return context
+        caches.paths.pop(uid, None)  # expired or stale
+        return None
     
-    def _load_globals(self):
-        self.portal = getSite()
-        self.catalog = getToolByName(self.portal, 'portal_catalog')
-        self.loaded = True
+    def _known_missing(self, caches, uid):
+        expires = caches.misses.get(uid)
+        if expires is None:
+            return False
+        if expires > time.time():
+            return True
+        del(caches.misses[uid])
+        return False
+    
+    def _remember_missing(self, caches, uid):
+        misses = caches.misses
+        misses.pop(uid, None)  # re-insert as newest
+        misses[uid] = time.time() + self.MISS_TTL
+        if len(misses) > self.CACHE_SIZE:
+            misses.popitem(last=False)  # drop oldest
+    
+    def _remember(self, caches, uid, path):
+        paths = caches.paths
+        if len(paths) >= self.CACHE_SIZE:
+            paths.clear()
+        paths[uid] = (time.time() + self.CACHE_TTL, path)
     
     def __call__(self, uid, _context=None):
-        if not self.loaded:
-            self._load_globals()
         if _context is None:
             _context = self.context(uid)
-        return _context.get(uid, None)
+            if _context is None:
+                return None
+        return _context.get(str(uid), None)
     
     def context(self, uid):
-        if not self.loaded:
-            self._load_globals()
-        brains = self.catalog.query({self.INDEX_NAME: str(uid)})
-        if brains:
-            return brains[0].getObject()  # first location should be only.
+        uid = str(uid)
+        caches = _caches()
+        context = self._cached_context(caches, uid)
+        if context is not None:
+            return context
+        if self._known_missing(caches, uid):
+            return None
+        brains = caches.catalog.query({self.INDEX_NAME: uid})
+        brain = next(iter(brains), None)  # first location should be only.
+        if brain is not None:
+            context = brain.getObject()
+            self._remember(caches, uid, brain.getPath())
+            return context
+        self._remember_missing(caches, uid)
         return None
     
+    def resolve_many(self, uids, context=None):
+        """
+        Given a sequence of UIDs, return a dict mapping each (string) UID
+        to its record, or to None if not found.  UIDs with remembered
+        context paths are grouped by parent, so each parent is traversed
+        once; all other UIDs are looked up with a single catalog query.
+        No query is made at all when the caller passes a known context
+        containing the records.
+        """
+        uids = [str(uid) for uid in uids]
+        if context is not None:
+            return dict([(uid, context.get(uid, None)) for uid in uids])
+        caches = _caches()
+        paths, misses = caches.paths, caches.misses
+        result = dict.fromkeys(uids)
+        remaining = set(uids)
+        # group UIDs with remembered paths by parent, traversing each
+        # parent once for all of its UIDs, before querying for the rest.
+        by_path = {}
+        now = time.time()
+        for uid in remaining:
+            cached = paths.get(uid)
+            if cached is not None and cached[0] > now:
+                by_path.setdefault(cached[1], []).append(uid)
+        for path, path_uids in by_path.items():
+            context = caches.portal.restrictedTraverse(path, None)
+            if context is None:
+                continue
+            for uid in path_uids:
+                record = context.get(uid, None)
+                if record is not None:
+                    result[uid] = record
+                    remaining.discard(uid)
+        remaining = set(
+            uid for uid in remaining if not self._known_missing(caches, uid)
+            )
+        if not remaining:
+            return result
+        query = {
+            self.INDEX_NAME: {'query': list(remaining), 'operator': 'or'},
+            }
+        for brain in caches.catalog.query(query):
+            if not remaining:
+                break
+            context = brain.getObject()
+            path = brain.getPath()
+            for uid in list(remaining):
+                record = context.get(uid, None)
+                if record is not None:
+                    result[uid] = record
+                    remaining.discard(uid)
+                    self._remember(caches, uid, path)
+                    misses.pop(uid, None)
+        for uid in remaining:
+            self._remember_missing(caches, uid)
+        return result
+    
     def contained(self, uid):
-        if not self.loaded:
-            self._load_globals()
         context = self.context(uid)
         if context is None:
             return (None, None)
-        return (context, self(uid, context))
+        return (context, context.get(str(uid), None))
+
+
+# process-wide singleton, registered as IRecordResolver utility by the
+# optional resolver.zcml.
+resolver = CatalogRecordResolver()
 
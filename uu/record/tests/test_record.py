@@ -1,11 +1,15 @@
 import doctest
 import unittest2 as unittest
-import uu.record.base
 
 
 def test_suite():
+    import uu.record.base
+    import uu.record.resolver
     suite = unittest.TestSuite()
-    suite.addTests([doctest.DocTestSuite(uu.record.base)])
+    suite.addTests([
+        doctest.DocTestSuite(uu.record.base),
+        doctest.DocTestSuite(uu.record.resolver),
+        ])
     return suite
 
 if __name__ == '__main__':
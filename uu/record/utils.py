@@ -10,10 +10,16 @@ try:
         is that content rules are greedily assuming all notified objects
         are contentish.
         """
-        _status.rule_filter = DuplicateRuleFilter()
-        _status.rule_filter.in_progress = True
-        base_notify(*args, **kwargs)
-        _status.rule_filter.in_progress = False
+        rule_filter = getattr(_status, 'rule_filter', None)
+        if rule_filter is None:
+            # one filter per thread, reset by plone.app.contentrules itself
+            rule_filter = _status.rule_filter = DuplicateRuleFilter()
+        in_progress = rule_filter.in_progress
+        rule_filter.in_progress = True
+        try:
+            base_notify(*args, **kwargs)
+        finally:
+            rule_filter.in_progress = in_progress  # restore, even on error
 
 
 except ImportError: